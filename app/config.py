@@ -7,6 +7,7 @@ class Settings(BaseSettings):
     # AWS Settings
     aws_region: str = "us-east-1"
     aws_secret_name: str = "snowflake-credentials"
+    secret_cache_ttl_seconds: int = 3600
     
     # Snowflake Settings (will be loaded from AWS Secrets Manager)
     snowflake_account: Optional[str] = None
@@ -17,10 +18,19 @@ class Settings(BaseSettings):
     snowflake_schema: Optional[str] = None
     snowflake_role: Optional[str] = None
     
+    # Snowflake connection pool settings
+    snowflake_pool_size: int = 8
+    snowflake_pool_timeout: int = 120
+    
     # API Settings
     api_title: str = "FastAPI Snowflake API"
     api_version: str = "1.0.0"
     debug: bool = False
+    threadpool_size: int = 64
+    
+    # Read cache settings
+    health_cache_ttl_seconds: int = 10
+    user_cache_ttl_seconds: int = 1
     
     model_config = {
         "env_file": ".env",
@@ -1,53 +1,120 @@
-import snowflake.connector
-from typing import Dict, List, Any, Optional
+from typing import TYPE_CHECKING, Dict, Iterator, List, Any, Optional, Tuple
 from contextlib import contextmanager
+from importlib.util import find_spec
 from app.secrets import secrets_manager
 from app.config import settings
 import logging
+import threading
+
+# The Snowflake connector, SQLAlchemy and pyarrow take several hundred ms to
+# import, so they are imported on first use to keep Lambda cold starts short.
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from sqlalchemy.pool import QueuePool
+
+# Arrow results are optional; see execute_query_arrow
+_HAS_PYARROW = find_spec("pyarrow") is not None
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on rows per bulk MERGE, so one request can't build an unbounded statement
+_BULK_INSERT_CHUNK_SIZE = 1000
+
+# Session / master token expired or invalid. The connector raises these as a
+# ProgrammingError without closing the connection, so is_closed() stays False.
+_SESSION_EXPIRED_ERRNOS = frozenset({390112, 390113, 390114, 390115})
+
+
+def _is_disconnect(connection, error: Exception) -> bool:
+    """Whether a pooled connection can no longer be used after ``error``."""
+    from snowflake.connector.errors import DatabaseError
+    
+    if connection.is_closed():
+        return True
+    return isinstance(error, DatabaseError) and (
+        error.sqlstate == "08001" or error.errno in _SESSION_EXPIRED_ERRNOS
+    )
+
 
 class SnowflakeConnection:
     def __init__(self):
-        self._connection = None
-        self._credentials = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
     
     def _get_credentials(self) -> Dict[str, str]:
-        """Get Snowflake credentials from AWS Secrets Manager."""
-        if not self._credentials:
-            try:
-                self._credentials = secrets_manager.get_snowflake_credentials()
-            except Exception as e:
-                logger.error(f"Failed to retrieve Snowflake credentials: {str(e)}")
-                raise
-        return self._credentials
+        """
+        Get Snowflake credentials from AWS Secrets Manager.
+        
+        The secrets manager caches the secret, so this is cheap to call for
+        every new connection and picks up rotated credentials without a restart.
+        """
+        try:
+            return secrets_manager.get_snowflake_credentials()
+        except Exception as e:
+            logger.error(f"Failed to retrieve Snowflake credentials: {str(e)}")
+            raise
+    
+    def _connect(self):
+        """Open a new Snowflake connection; used as the pool's creator."""
+        import snowflake.connector
+        
+        credentials = self._get_credentials()
+        
+        return snowflake.connector.connect(
+            account=credentials.get('account'),
+            user=credentials.get('user'),
+            password=credentials.get('password'),
+            warehouse=credentials.get('warehouse'),
+            database=credentials.get('database'),
+            schema=credentials.get('schema'),
+            role=credentials.get('role'),
+            # Serve identical repeated reads from Snowflake's result cache
+            session_parameters={'USE_CACHED_RESULT': True},
+            # Pooled connections can sit idle; keep their sessions from expiring
+            client_session_keep_alive=True
+        )
+    
+    def _get_pool(self) -> "QueuePool":
+        """Lazily build the connection pool on first use."""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    from sqlalchemy.pool import QueuePool
+                    
+                    self._pool = QueuePool(
+                        self._connect,
+                        pool_size=settings.snowflake_pool_size,
+                        max_overflow=0,
+                        timeout=settings.snowflake_pool_timeout,
+                        recycle=-1,
+                        # Snowflake autocommits, so skip the ROLLBACK round trip on return
+                        reset_on_return=None
+                    )
+        return self._pool
     
     @contextmanager
     def get_connection(self):
-        """Context manager for Snowflake database connections."""
-        connection = None
+        """
+        Context manager for Snowflake database connections.
+        
+        Connections are borrowed from a pool and returned to it on exit,
+        so the Snowflake login handshake is only paid once per pooled connection.
+        """
+        pooled = None
         try:
-            credentials = self._get_credentials()
-            
-            connection = snowflake.connector.connect(
-                account=credentials.get('account'),
-                user=credentials.get('user'),
-                password=credentials.get('password'),
-                warehouse=credentials.get('warehouse'),
-                database=credentials.get('database'),
-                schema=credentials.get('schema'),
-                role=credentials.get('role')
-            )
+            pooled = self._get_pool().connect()
             
-            yield connection
+            yield pooled.dbapi_connection
             
         except Exception as e:
             logger.error(f"Database connection error: {str(e)}")
+            if pooled is not None and _is_disconnect(pooled.dbapi_connection, e):
+                # Don't hand a dead session back out to the next caller
+                pooled.invalidate()
             raise
         finally:
-            if connection:
-                connection.close()
+            if pooled is not None:
+                pooled.close()
     
     def execute_query(self, query: str, params: Optional[Dict] = None) -> List[Dict[str, Any]]:
         """
@@ -60,6 +127,79 @@ class SnowflakeConnection:
         Returns:
             List of dictionaries representing query results
         """
+        with self.get_connection() as conn:
+            from snowflake.connector import DictCursor
+            
+            cursor = conn.cursor(DictCursor)
+            try:
+                if params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                
+                # DictCursor already yields rows keyed by column name
+                return cursor.fetchall()
+                
+            finally:
+                cursor.close()
+    
+    def iter_query_batches(self, query: str, params: Optional[Dict] = None,
+                           batch_size: int = 1000) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Execute a query and lazily yield results in batches of dictionaries.
+        
+        Rows are fetched from Snowflake one batch per round trip, so memory use
+        is bounded by the batch size rather than the full result. The pooled
+        connection stays checked out until the iterator is exhausted or closed.
+        
+        Args:
+            query: SQL query to execute
+            params: Optional parameters for the query
+            batch_size: Number of rows to fetch per round trip
+            
+        Yields:
+            Lists of up to ``batch_size`` dictionaries representing result rows
+        """
+        with self.get_connection() as conn:
+            from snowflake.connector import DictCursor
+            
+            cursor = conn.cursor(DictCursor)
+            try:
+                cursor.arraysize = batch_size
+                if params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+                
+            finally:
+                cursor.close()
+    
+    def execute_query_arrow(self, query: str, params: Optional[Dict] = None) -> "pa.Table":
+        """
+        Execute a query and return results as a PyArrow table.
+        
+        Results are transferred column-major in Arrow format, skipping the
+        per-row Python conversion entirely. Requires pyarrow, which is installed
+        with ``snowflake-connector-python[pandas]``.
+        
+        Args:
+            query: SQL query to execute
+            params: Optional parameters for the query
+            
+        Returns:
+            PyArrow table holding the query results
+        """
+        if not _HAS_PYARROW:
+            raise RuntimeError("Arrow results require pyarrow; install snowflake-connector-python[pandas]")
+        
+        import pyarrow as pa
+        
         with self.get_connection() as conn:
             cursor = conn.cursor()
             try:
@@ -68,15 +208,47 @@ class SnowflakeConnection:
                 else:
                     cursor.execute(query)
                 
-                # Get column names
-                columns = [desc[0] for desc in cursor.description]
+                table = cursor.fetch_arrow_all()
+                if table is None:
+                    # Empty results come back as None; keep the column names
+                    table = pa.table({desc[0]: pa.array([]) for desc in cursor.description})
                 
-                # Fetch all results and convert to list of dictionaries
-                results = []
-                for row in cursor.fetchall():
-                    results.append(dict(zip(columns, row)))
+                return table
                 
-                return results
+            finally:
+                cursor.close()
+    
+    def execute_query_columnar(self, query: str, params: Optional[Dict] = None) -> Dict[str, List[Any]]:
+        """
+        Execute a query and return results column-major.
+        
+        Uses the Arrow fetch path when pyarrow is installed, otherwise
+        transposes plain row tuples. Either way the column names come from the
+        result schema, so an empty result still lists its columns.
+        
+        Args:
+            query: SQL query to execute
+            params: Optional parameters for the query
+            
+        Returns:
+            Dictionary mapping each column name to its list of values
+        """
+        if _HAS_PYARROW:
+            return self.execute_query_arrow(query, params).to_pydict()
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                
+                rows = cursor.fetchall()
+                columns = {desc[0]: [] for desc in cursor.description}
+                for name, values in zip(columns, zip(*rows)):
+                    columns[name] = list(values)
+                return columns
                 
             finally:
                 cursor.close()
@@ -105,10 +277,94 @@ class SnowflakeConnection:
             finally:
                 cursor.close()
     
+    def execute_returning(self, statement: str, query: str,
+                          params: Optional[Dict] = None) -> Optional[Dict[str, Any]]:
+        """
+        Execute a statement, then a query on the same connection, returning one row.
+        
+        Stands in for INSERT ... RETURNING, which Snowflake doesn't support:
+        both run over a single borrowed connection and cursor.
+        
+        Args:
+            statement: SQL statement to execute (INSERT, UPDATE, DELETE)
+            query: SQL query that reads back the affected row
+            params: Optional parameters shared by both
+            
+        Returns:
+            Dictionary for the first row of the query, or None if there is none
+        """
+        with self.get_connection() as conn:
+            from snowflake.connector import DictCursor
+            
+            cursor = conn.cursor(DictCursor)
+            try:
+                cursor.execute(statement, params)
+                cursor.execute(query, params)
+                
+                return cursor.fetchone()
+                
+            finally:
+                cursor.close()
+    
+    def bulk_insert_users(self, users: List[Tuple[str, str]]) -> int:
+        """
+        Insert many users, skipping emails that already exist.
+        
+        Like ``register_user_if_not_exists``, inserts go through a MERGE on
+        email, here with a multi-row VALUES source so each chunk of up to
+        ``_BULK_INSERT_CHUNK_SIZE`` users is one statement. Duplicate emails
+        in ``users`` are dropped, keeping the first name given.
+        
+        Args:
+            users: (name, email) pairs to insert
+            
+        Returns:
+            Number of inserted rows
+        """
+        names_by_email: Dict[str, str] = {}
+        for name, email in users:
+            names_by_email.setdefault(email, name)
+        if not names_by_email:
+            return 0
+        
+        rows = [(name, email) for email, name in names_by_email.items()]
+        inserted = 0
+        
+        with self.get_connection() as conn:
+            from snowflake.connector import DictCursor
+            
+            cursor = conn.cursor(DictCursor)
+            try:
+                for start in range(0, len(rows), _BULK_INSERT_CHUNK_SIZE):
+                    chunk = rows[start:start + _BULK_INSERT_CHUNK_SIZE]
+                    merge_query = f"""
+                    MERGE INTO users t 
+                    USING (
+                        SELECT column1 AS name, column2 AS email 
+                        FROM VALUES {", ".join(["(%s, %s)"] * len(chunk))}
+                    ) s 
+                    ON t.email = s.email 
+                    WHEN NOT MATCHED THEN INSERT (name, email, created_at) 
+                    VALUES (s.name, s.email, CURRENT_TIMESTAMP())
+                    """
+                    
+                    cursor.execute(merge_query, [value for row in chunk for value in row])
+                    counts = cursor.fetchone() or {}
+                    inserted += counts.get("number of rows inserted", 0)
+                
+                return inserted
+                
+            finally:
+                cursor.close()
+    
     def register_user_if_not_exists(self, name: str, email: str) -> Dict[str, Any]:
         """
         Register a user if they don't exist, or return existing user.
         
+        The insert-or-rename is done in a single MERGE, whose result row
+        reports whether a row was inserted or updated, followed by one SELECT
+        to read the user back.
+        
         Args:
             name: User's name
             email: User's email address
@@ -117,70 +373,47 @@ class SnowflakeConnection:
             Dictionary with user data and creation status
         """
         with self.get_connection() as conn:
-            cursor = conn.cursor()
+            from snowflake.connector import DictCursor
+            
+            cursor = conn.cursor(DictCursor)
             try:
-                # Check if user exists
-                check_query = """
-                SELECT id, name, email, created_at 
-                FROM users 
-                WHERE email = %(email)s
+                # Insert the user, or update the name if it changed
+                merge_query = """
+                MERGE INTO users t 
+                USING (SELECT %(name)s AS name, %(email)s AS email) s 
+                ON t.email = s.email 
+                WHEN MATCHED AND t.name <> s.name THEN UPDATE SET name = s.name 
+                WHEN NOT MATCHED THEN INSERT (name, email, created_at) 
+                VALUES (s.name, s.email, CURRENT_TIMESTAMP())
                 """
                 
-                cursor.execute(check_query, {"email": email})
-                existing_user = cursor.fetchone()
+                cursor.execute(merge_query, {"name": name, "email": email})
+                counts = cursor.fetchone() or {}
+                created = counts.get("number of rows inserted", 0) > 0
+                updated = counts.get("number of rows updated", 0) > 0
                 
-                if existing_user:
-                    # User exists, check if we need to update the name
-                    columns = [desc[0] for desc in cursor.description]
-                    user_data = dict(zip(columns, existing_user))
-                    
-                    if user_data.get("NAME") != name:
-                        # Update the name
-                        update_query = """
-                        UPDATE users 
-                        SET name = %(name)s 
-                        WHERE email = %(email)s
-                        """
-                        cursor.execute(update_query, {"name": name, "email": email})
-                        
-                        # Get updated user data
-                        cursor.execute(check_query, {"email": email})
-                        updated_user = cursor.fetchone()
-                        user_data = dict(zip(columns, updated_user))
-                        
-                        return {
-                            "user": user_data,
-                            "created": False,
-                            "updated": True,
-                            "message": f"User already existed, name updated to {name}"
-                        }
-                    
-                    return {
-                        "user": user_data,
-                        "created": False,
-                        "updated": False,
-                        "message": f"User already exists with email {email}"
-                    }
-                
-                # User doesn't exist, create new user
-                insert_query = """
-                INSERT INTO users (name, email, created_at) 
-                VALUES (%(name)s, %(email)s, CURRENT_TIMESTAMP())
+                # Get the current user data
+                select_query = """
+                SELECT id, name, email, created_at 
+                FROM users 
+                WHERE email = %(email)s
                 """
                 
-                cursor.execute(insert_query, {"name": name, "email": email})
+                cursor.execute(select_query, {"email": email})
+                user_data = cursor.fetchone()
                 
-                # Get the created user
-                cursor.execute(check_query, {"email": email})
-                new_user = cursor.fetchone()
-                columns = [desc[0] for desc in cursor.description]
-                user_data = dict(zip(columns, new_user))
+                if created:
+                    message = f"New user created with email {email}"
+                elif updated:
+                    message = f"User already existed, name updated to {name}"
+                else:
+                    message = f"User already exists with email {email}"
                 
                 return {
                     "user": user_data,
-                    "created": True,
-                    "updated": False,
-                    "message": f"New user created with email {email}"
+                    "created": created,
+                    "updated": updated,
+                    "message": message
                 }
                 
             finally:
@@ -1,27 +1,90 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from typing import List, Optional
-from datetime import datetime
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Union
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import anyio
+import itertools
+import threading
 import time
 import logging
 
+import orjson
+from cachetools import TTLCache
+from pydantic import TypeAdapter
+from pydantic_core import to_json
+
 from app.config import settings
 from app.database import snowflake_db
 from app.models import (
-    HealthCheck, QueryRequest, QueryResponse, ErrorResponse,
-    User, UserCreate, UserUpdate, UserRegistrationResponse
+    HealthCheck, QueryRequest, QueryResponse, QueryResponseColumnar, ErrorResponse,
+    User, UserCreate, UserUpdate, UserRegistrationResponse, UserRow
 )
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Database-bound routes are plain `def` handlers, so FastAPI runs them in
+    # the AnyIO worker thread pool; size it for concurrent Snowflake calls.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.threadpool_size
+    yield
+
+
+# Short-lived caches for hot, idempotent reads. TTLCache isn't thread-safe
+# and sync routes run in a thread pool, so access goes through the lock.
+_cache_lock = threading.Lock()
+health_cache = TTLCache(maxsize=1, ttl=settings.health_cache_ttl_seconds)
+user_cache = TTLCache(maxsize=1024, ttl=settings.user_cache_ttl_seconds)
+
+
+def _cache_get(cache: TTLCache, key: Any) -> Any:
+    with _cache_lock:
+        return cache.get(key)
+
+
+def _cache_set(cache: TTLCache, key: Any, value: Any) -> None:
+    with _cache_lock:
+        cache[key] = value
+
+
+def _invalidate_user(user_id: Optional[int]) -> None:
+    with _cache_lock:
+        user_cache.pop(user_id, None)
+
+
+# Built once; serializes a whole user list to JSON in pydantic-core. Rows come
+# straight from Snowflake with a known schema, so they skip User validation.
+_user_rows_adapter = TypeAdapter(List[UserRow])
+
+
+class _JSONResponse(ORJSONResponse):
+    """
+    ORJSONResponse that falls back to pydantic-core for content orjson rejects.
+    
+    orjson can't encode integers wider than 64 bits, which Snowflake
+    NUMBER(38,0) columns can return.
+    """
+    
+    def render(self, content: Any) -> bytes:
+        try:
+            return super().render(content)
+        except orjson.JSONEncodeError:
+            return to_json(content)
+
+
 # Create FastAPI app
 app = FastAPI(
     title=settings.api_title,
     version=settings.api_version,
-    description="A FastAPI application with Snowflake integration for AWS Lambda deployment"
+    description="A FastAPI application with Snowflake integration for AWS Lambda deployment",
+    default_response_class=_JSONResponse,
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -33,38 +96,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger responses; JSON result sets shrink several-fold
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     logger.error(f"Global exception handler caught: {exc}")
-    return JSONResponse(
+    return Response(
         status_code=500,
         content=ErrorResponse(
             error="Internal Server Error",
             detail=str(exc),
-            timestamp=datetime.now()
-        ).dict()
+            timestamp=datetime.now(timezone.utc)
+        ).model_dump_json(),
+        media_type="application/json"
     )
 
 
+# Last /health response and the 100ms tick it was built in; load balancers
+# probe this constantly, so it is rebuilt at most ten times a second.
+_health_response: Tuple[int, Optional[HealthCheck]] = (-1, None)
+
+
 @app.get("/health", response_model=HealthCheck)
 async def health_check():
     """Health check endpoint."""
-    return HealthCheck(
-        status="healthy",
-        timestamp=datetime.now(),
-        version=settings.api_version
-    )
+    global _health_response
+    tick = time.monotonic_ns() // 100_000_000
+    cached_tick, response = _health_response
+    if tick != cached_tick or response is None:
+        response = HealthCheck(
+            status="healthy",
+            timestamp=datetime.now(timezone.utc),
+            version=settings.api_version
+        )
+        _health_response = (tick, response)
+    return response
 
 
 @app.get("/health/database")
-async def database_health_check():
+def database_health_check():
     """Database health check endpoint."""
+    cached = _cache_get(health_cache, "database")
+    if cached is not None:
+        return cached
+    
     try:
         # Simple query to test database connection
         result = snowflake_db.execute_query("SELECT 1 as test")
         if result and result[0].get("TEST") == 1:
-            return {"status": "healthy", "database": "connected", "timestamp": datetime.now()}
+            status = {"status": "healthy", "database": "connected", "timestamp": datetime.now(timezone.utc)}
+            _cache_set(health_cache, "database", status)
+            return status
         else:
             raise HTTPException(status_code=503, detail="Database connection test failed")
     except Exception as e:
@@ -72,12 +156,83 @@ async def database_health_check():
         raise HTTPException(status_code=503, detail=f"Database connection failed: {str(e)}")
 
 
-@app.post("/query", response_model=QueryResponse)
-async def execute_query(query_request: QueryRequest):
-    """Execute a custom SQL query."""
+def _ndjson_chunks(batches: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    """
+    Encode batches of result rows as newline-delimited JSON.
+    
+    Each batch becomes one chunk, so the response is written once per fetch
+    rather than once per row.
+    """
+    for batch in batches:
+        yield b"\n".join([to_json(row) for row in batch]) + b"\n"
+
+
+def _arrow_ipc_stream(table) -> bytes:
+    """Serialize a PyArrow table in the Arrow IPC streaming format."""
+    import pyarrow as pa
+    
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+@app.post("/query", response_model=Union[QueryResponse, QueryResponseColumnar])
+def execute_query(
+    query_request: QueryRequest,
+    format: Literal["json", "columnar", "ndjson", "arrow"] = "json"
+):
+    """
+    Execute a custom SQL query.
+    
+    With ``format=columnar`` data is returned as one list per column, so
+    column names appear once instead of in every row. With ``format=ndjson``
+    rows are streamed back one JSON object per line instead of being
+    collected into a single response body. With ``format=arrow`` the result
+    is returned as an Arrow IPC stream.
+    """
     try:
+        if format == "arrow":
+            table = snowflake_db.execute_query_arrow(
+                query_request.query,
+                query_request.parameters
+            )
+            
+            return Response(
+                content=_arrow_ipc_stream(table),
+                media_type="application/vnd.apache.arrow.stream"
+            )
+        
+        if format == "ndjson":
+            batches = snowflake_db.iter_query_batches(
+                query_request.query,
+                query_request.parameters
+            )
+            
+            # Pull the first batch eagerly so query errors still surface as a 400
+            first = next(batches, None)
+            if first is not None:
+                batches = itertools.chain((first,), batches)
+            
+            return StreamingResponse(_ndjson_chunks(batches), media_type="application/x-ndjson")
+        
         start_time = time.time()
         
+        if format == "columnar":
+            columns = snowflake_db.execute_query_columnar(
+                query_request.query,
+                query_request.parameters
+            )
+            
+            execution_time = (time.time() - start_time) * 1000  # Convert to milliseconds
+            
+            return QueryResponseColumnar(
+                columns=list(columns),
+                data=columns,
+                row_count=len(next(iter(columns.values()), [])),
+                execution_time_ms=round(execution_time, 2)
+            )
+        
         # Execute the query
         results = snowflake_db.execute_query(
             query_request.query,
@@ -86,11 +241,17 @@ async def execute_query(query_request: QueryRequest):
         
         execution_time = (time.time() - start_time) * 1000  # Convert to milliseconds
         
-        return QueryResponse(
-            data=results,
-            row_count=len(results),
-            execution_time_ms=round(execution_time, 2)
-        )
+        # Rows are plain dicts from the cursor; encode them straight to bytes in
+        # pydantic-core rather than validating each one through QueryResponse
+        # first. Unlike orjson it handles NUMBER(38,0) ints wider than 64 bits,
+        # Decimal and BINARY values, matching the model's output.
+        content = to_json({
+            "data": results,
+            "row_count": len(results),
+            "execution_time_ms": round(execution_time, 2)
+        })
+        
+        return Response(content=content, media_type="application/json")
         
     except Exception as e:
         logger.error(f"Query execution failed: {str(e)}")
@@ -98,7 +259,7 @@ async def execute_query(query_request: QueryRequest):
 
 
 @app.get("/users", response_model=List[User])
-async def get_users(limit: Optional[int] = 100):
+def get_users(limit: Optional[int] = 100):
     """Get all users from the database."""
     try:
         query = """
@@ -110,17 +271,17 @@ async def get_users(limit: Optional[int] = 100):
         
         results = snowflake_db.execute_query(query, {"limit": limit})
         
-        # Convert results to User models
-        users = []
-        for row in results:
-            users.append(User(
+        users = [
+            UserRow(
                 id=row.get("ID"),
                 name=row.get("NAME"),
                 email=row.get("EMAIL"),
                 created_at=row.get("CREATED_AT")
-            ))
+            )
+            for row in results
+        ]
         
-        return users
+        return Response(content=_user_rows_adapter.dump_json(users), media_type="application/json")
         
     except Exception as e:
         logger.error(f"Get users failed: {str(e)}")
@@ -128,8 +289,12 @@ async def get_users(limit: Optional[int] = 100):
 
 
 @app.get("/users/{user_id}", response_model=User)
-async def get_user(user_id: int):
+def get_user(user_id: int):
     """Get a specific user by ID."""
+    cached = _cache_get(user_cache, user_id)
+    if cached is not None:
+        return cached
+    
     try:
         query = """
         SELECT id, name, email, created_at 
@@ -143,12 +308,14 @@ async def get_user(user_id: int):
             raise HTTPException(status_code=404, detail="User not found")
         
         row = results[0]
-        return User(
+        user = User(
             id=row.get("ID"),
             name=row.get("NAME"),
             email=row.get("EMAIL"),
             created_at=row.get("CREATED_AT")
         )
+        _cache_set(user_cache, user_id, user)
+        return user
         
     except HTTPException:
         raise
@@ -158,56 +325,32 @@ async def get_user(user_id: int):
 
 
 @app.post("/users", response_model=User)
-async def create_user(user: UserCreate):
+def create_user(user: UserCreate):
     """Create a new user if they don't already exist."""
     try:
-        # First check if user already exists by email
-        check_query = """
-        SELECT id, name, email, created_at 
-        FROM users 
-        WHERE email = %(email)s
-        """
-        
-        existing_users = snowflake_db.execute_query(check_query, {"email": user.email})
-        
-        # If user already exists, return the existing user
-        if existing_users:
-            logger.info(f"User with email {user.email} already exists, returning existing user")
-            row = existing_users[0]
-            return User(
-                id=row.get("ID"),
-                name=row.get("NAME"),
-                email=row.get("EMAIL"),
-                created_at=row.get("CREATED_AT")
-            )
-        
-        # User doesn't exist, create new user
-        logger.info(f"Creating new user with email {user.email}")
+        # Insert only if the email is new, then read the user back on the same
+        # connection; Snowflake has no INSERT ... RETURNING
         insert_query = """
         INSERT INTO users (name, email, created_at) 
-        VALUES (%(name)s, %(email)s, CURRENT_TIMESTAMP())
+        SELECT %(name)s, %(email)s, CURRENT_TIMESTAMP() 
+        WHERE NOT EXISTS (SELECT 1 FROM users WHERE email = %(email)s)
         """
         
-        snowflake_db.execute_non_query(insert_query, {
-            "name": user.name,
-            "email": user.email
-        })
-        
-        # Get the created user
         select_query = """
         SELECT id, name, email, created_at 
         FROM users 
-        WHERE email = %(email)s 
-        ORDER BY created_at DESC 
-        LIMIT 1
+        WHERE email = %(email)s
         """
         
-        results = snowflake_db.execute_query(select_query, {"email": user.email})
+        logger.info(f"Creating user with email {user.email} if it doesn't already exist")
+        row = snowflake_db.execute_returning(insert_query, select_query, {
+            "name": user.name,
+            "email": user.email
+        })
         
-        if not results:
+        if not row:
             raise HTTPException(status_code=500, detail="Failed to retrieve created user")
         
-        row = results[0]
         return User(
             id=row.get("ID"),
             name=row.get("NAME"),
@@ -221,37 +364,33 @@ async def create_user(user: UserCreate):
 
 
 @app.put("/users/{user_id}", response_model=User)
-async def update_user(user_id: int, user_update: UserUpdate):
+def update_user(user_id: int, user_update: UserUpdate):
     """Update an existing user."""
     try:
-        # Build dynamic update query
-        update_fields = []
-        params = {"user_id": user_id}
-        
-        if user_update.name is not None:
-            update_fields.append("name = %(name)s")
-            params["name"] = user_update.name
-        
-        if user_update.email is not None:
-            update_fields.append("email = %(email)s")
-            params["email"] = user_update.email
-        
-        if not update_fields:
+        if user_update.name is None and user_update.email is None:
             raise HTTPException(status_code=400, detail="No fields to update")
         
-        update_query = f"""
+        # Fixed statement text; COALESCE keeps the current value for omitted fields
+        update_query = """
         UPDATE users 
-        SET {', '.join(update_fields)}
+        SET name = COALESCE(%(name)s, name), 
+            email = COALESCE(%(email)s, email) 
         WHERE id = %(user_id)s
         """
+        params = {
+            "user_id": user_id,
+            "name": user_update.name,
+            "email": user_update.email
+        }
         
         rows_affected = snowflake_db.execute_non_query(update_query, params)
+        _invalidate_user(user_id)
         
         if rows_affected == 0:
             raise HTTPException(status_code=404, detail="User not found")
         
         # Return updated user
-        return await get_user(user_id)
+        return get_user(user_id)
         
     except HTTPException:
         raise
@@ -261,12 +400,13 @@ async def update_user(user_id: int, user_update: UserUpdate):
 
 
 @app.delete("/users/{user_id}")
-async def delete_user(user_id: int):
+def delete_user(user_id: int):
     """Delete a user."""
     try:
         delete_query = "DELETE FROM users WHERE id = %(user_id)s"
         
         rows_affected = snowflake_db.execute_non_query(delete_query, {"user_id": user_id})
+        _invalidate_user(user_id)
         
         if rows_affected == 0:
             raise HTTPException(status_code=404, detail="User not found")
@@ -280,8 +420,21 @@ async def delete_user(user_id: int):
         raise HTTPException(status_code=500, detail=f"Failed to delete user: {str(e)}")
 
 
+@app.post("/users/bulk")
+def bulk_create_users(users: List[UserCreate]):
+    """Create many users, skipping emails that already exist."""
+    try:
+        inserted = snowflake_db.bulk_insert_users([(user.name, user.email) for user in users])
+        
+        return {"inserted": inserted}
+        
+    except Exception as e:
+        logger.error(f"Bulk create users failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to create users: {str(e)}")
+
+
 @app.post("/users/register", response_model=UserRegistrationResponse)
-async def register_user(user: UserCreate):
+def register_user(user: UserCreate):
     """Register a new user or return existing user if email already exists."""
     try:
         # Use the dedicated database method for registration
@@ -295,6 +448,8 @@ async def register_user(user: UserCreate):
             email=user_data.get("EMAIL"),
             created_at=user_data.get("CREATED_AT")
         )
+        if result.get("updated"):
+            _invalidate_user(user_obj.id)
         
         return UserRegistrationResponse(
             user=user_obj,
@@ -1,6 +1,44 @@
-from pydantic import BaseModel
-from typing import List, Optional, Any
+import re
+from pydantic import BaseModel, Field, field_validator
+from typing import Dict, List, Optional, Any
 from datetime import datetime
+from typing_extensions import TypedDict
+
+
+# Patterns for the /query allow-list. Possessive quantifiers stop backtracking
+# within a match, and every pattern is only ever matched at a fixed position
+# (never searched), so validation stays linear in the query length.
+_IGNORABLE = r"(?:\s++|--[^\n]*+|//[^\n]*+|/\*(?:[^*]|\*(?!/))*+\*/)"
+_READ_ONLY_STATEMENT = re.compile(
+    rf"(?:{_IGNORABLE}|\()*+(?:SELECT|WITH|SHOW|DESC(?:RIBE)?|EXPLAIN)\b", re.IGNORECASE
+)
+# One token at a time, left to right. Literals, quoted identifiers and
+# comments are consumed whole so a ';' inside them isn't taken as a separator;
+# an unterminated one runs to the end of the query and ends the scan.
+_QUERY_TOKEN = re.compile(
+    r"""(?P<ignorable>\s++|--[^\n]*+|//[^\n]*+|/\*(?:[^*]|\*(?!/))*+(?:\*/|\Z))"""
+    r"""|(?P<separator>;)"""
+    r"""|'(?:[^'\\]|\\.?|'')*+(?:'|\Z)"""
+    r"""|"(?:[^"]|"")*+(?:"|\Z)"""
+    r"""|\$\$(?:[^$]|\$(?!\$))*+(?:\$\$|\Z)"""
+    r"""|[^'"$;/\s-]++|.""",
+    re.DOTALL
+)
+_MAX_QUERY_LENGTH = 100_000
+
+
+def _has_second_statement(query: str) -> bool:
+    """Whether a ';' outside literals and comments is followed by more SQL."""
+    pos, end = 0, len(query)
+    after_separator = False
+    while pos < end:
+        token = _QUERY_TOKEN.match(query, pos)
+        if after_separator and token.lastgroup != "ignorable":
+            return True
+        if token.lastgroup == "separator":
+            after_separator = True
+        pos = token.end()
+    return False
 
 
 class HealthCheck(BaseModel):
@@ -10,8 +48,16 @@ class HealthCheck(BaseModel):
 
 
 class QueryRequest(BaseModel):
-    query: str
+    query: str = Field(max_length=_MAX_QUERY_LENGTH)
     parameters: Optional[dict] = None
+    
+    @field_validator("query")
+    @classmethod
+    def query_must_be_read_only(cls, value: str) -> str:
+        """Only accept a single read-only statement."""
+        if not _READ_ONLY_STATEMENT.match(value) or _has_second_statement(value):
+            raise ValueError("Only a single SELECT, WITH, SHOW, DESCRIBE or EXPLAIN statement is allowed")
+        return value
 
 
 class QueryResponse(BaseModel):
@@ -20,6 +66,13 @@ class QueryResponse(BaseModel):
     execution_time_ms: float
 
 
+class QueryResponseColumnar(BaseModel):
+    columns: List[str]
+    data: Dict[str, List[Any]]
+    row_count: int
+    execution_time_ms: float
+
+
 class ErrorResponse(BaseModel):
     error: str
     detail: Optional[str] = None
@@ -33,6 +86,14 @@ class User(BaseModel):
     created_at: Optional[datetime] = None
 
 
+class UserRow(TypedDict):
+    """User as read from Snowflake; serialized without per-row validation."""
+    id: Optional[int]
+    name: str
+    email: str
+    created_at: Optional[datetime]
+
+
 class UserCreate(BaseModel):
     name: str
     email: str
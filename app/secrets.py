@@ -1,15 +1,98 @@
 import json
-import boto3
-from typing import Dict, Any
+import logging
+import threading
+import time
+from functools import cache
+from typing import Dict, Any, Tuple
 from botocore.exceptions import ClientError
 from app.config import settings
 
+logger = logging.getLogger(__name__)
+
+# After a failed refresh, how long to keep serving the stale secret before retrying
+_REFRESH_RETRY_SECONDS = 60
+
+
+@cache
+def _get_client():
+    """
+    Build the Secrets Manager client once per process.
+    
+    boto3 is imported here rather than at module level because it adds
+    noticeably to Lambda cold starts, and routes like /health never need it.
+    Client creation itself loads service models and is comparatively slow, so
+    every SecretsManager shares one client, and it survives warm invocations.
+    """
+    import boto3
+    from botocore.config import Config
+    
+    return boto3.client(
+        'secretsmanager',
+        region_name=settings.aws_region,
+        config=Config(max_pool_connections=50, retries={'mode': 'adaptive'})
+    )
+
 
 class SecretsManager:
     def __init__(self):
-        self.client = boto3.client('secretsmanager', region_name=settings.aws_region)
+        self._client = None
+        self._cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def client(self):
+        """The shared boto3 client, created on first use."""
+        if self._client is None:
+            self._client = _get_client()
+        return self._client
     
     def get_secret(self, secret_name: str) -> Dict[str, Any]:
+        """
+        Retrieve a secret, serving it from an in-process cache when fresh.
+        
+        Cached values are refreshed from AWS Secrets Manager once they are older
+        than ``settings.secret_cache_ttl_seconds``. If a refresh fails, the last
+        known value is returned instead of raising, and the next refresh is
+        attempted after ``_REFRESH_RETRY_SECONDS``, so throttling or a brief
+        outage doesn't take the API down.
+        
+        Args:
+            secret_name: The name of the secret to retrieve
+            
+        Returns:
+            Dictionary containing the secret values
+            
+        Raises:
+            Exception: If the secret cannot be retrieved and nothing is cached
+        """
+        cached = self._cache.get(secret_name)
+        if cached and time.monotonic() - cached[0] < settings.secret_cache_ttl_seconds:
+            return cached[1]
+        
+        with self._lock:
+            # Another thread may have refreshed it while we waited for the lock
+            cached = self._cache.get(secret_name)
+            if cached and time.monotonic() - cached[0] < settings.secret_cache_ttl_seconds:
+                return cached[1]
+            
+            try:
+                secret = self._fetch_secret(secret_name)
+            except Exception as e:
+                if cached:
+                    logger.warning(f"Refreshing secret {secret_name} failed, using cached value: {str(e)}")
+                    # Keep serving the stale value and retry later, rather than
+                    # calling AWS again on every request while it's failing
+                    self._cache[secret_name] = (
+                        time.monotonic() - settings.secret_cache_ttl_seconds + _REFRESH_RETRY_SECONDS,
+                        cached[1]
+                    )
+                    return cached[1]
+                raise
+            
+            self._cache[secret_name] = (time.monotonic(), secret)
+            return secret
+    
+    def _fetch_secret(self, secret_name: str) -> Dict[str, Any]:
         """
         Retrieve a secret from AWS Secrets Manager.
         
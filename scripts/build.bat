@@ -33,6 +33,9 @@ copy requirements.txt dist\
 REM Install dependencies in dist folder for Lambda
 cd dist
 pip install -r requirements.txt -t .
+
+REM Precompile bytecode so Lambda cold starts don't recompile (build with the runtime's Python version)
+python -m compileall -q .
 cd ..
 
 REM Create deployment zip using PowerShell
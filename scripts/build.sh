@@ -36,12 +36,17 @@ cp requirements.txt dist/
 # Install dependencies in dist folder for Lambda
 cd dist
 pip install -r requirements.txt -t .
+
+# Precompile bytecode; /var/task is read-only on Lambda, so without shipped
+# .pyc files every cold start recompiles the app and its dependencies.
+# Build with the same Python version as the Lambda runtime.
+python -m compileall -q .
 cd ..
 
 # Create deployment zip
 echo "🗜️ Creating deployment package..."
 cd dist
-zip -r ../lambda_deployment.zip . -x "*.pyc" "__pycache__/*" "*.git*"
+zip -r ../lambda_deployment.zip . -x "*.git*"
 cd ..
 
 echo "✅ Build complete! Deployment package: lambda_deployment.zip"
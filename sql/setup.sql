@@ -18,8 +18,10 @@ INSERT INTO users (name, email) VALUES
     ('Charlie Wilson', 'charlie.wilson@example.com')
 ON CONFLICT (email) DO NOTHING;
 
--- Create an index on email for better performance
-CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+-- Speed up the email equality lookups used by user creation and registration.
+-- Snowflake has no secondary indexes; search optimization is the equivalent
+-- (requires Enterprise Edition). Safe to run on an existing table.
+ALTER TABLE users ADD SEARCH OPTIMIZATION ON EQUALITY(email);
 
 -- Create a view for user statistics (optional)
 CREATE OR REPLACE VIEW user_stats AS
@@ -42,15 +44,13 @@ FROM users;
 -- Check if user exists
 SELECT id, name, email, created_at FROM users WHERE email = 'test@example.com';
 
--- Register new user (if not exists)
-INSERT INTO users (name, email) 
-SELECT 'Test User', 'test@example.com' 
-WHERE NOT EXISTS (SELECT 1 FROM users WHERE email = 'test@example.com');
-
--- Update existing user's name
-UPDATE users 
-SET name = 'Updated Name', updated_at = CURRENT_TIMESTAMP() 
-WHERE email = 'test@example.com';
+-- Register new user, or update the name of an existing one, in a single statement
+MERGE INTO users t 
+USING (SELECT 'Test User' AS name, 'test@example.com' AS email) s 
+ON t.email = s.email 
+WHEN MATCHED AND t.name <> s.name THEN UPDATE SET name = s.name 
+WHEN NOT MATCHED THEN INSERT (name, email, created_at) 
+VALUES (s.name, s.email, CURRENT_TIMESTAMP());
 
 -- Get user statistics
 SELECT * FROM user_stats;
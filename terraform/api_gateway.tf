@@ -3,6 +3,9 @@ resource "aws_api_gateway_rest_api" "main" {
   name        = "${var.project_name}-${var.environment}-api"
   description = "FastAPI with Snowflake integration"
 
+  # Gzip-compressed and Arrow responses are binary; Mangum base64-encodes them
+  binary_media_types = ["*/*"]
+
   endpoint_configuration {
     types = ["REGIONAL"]
   }
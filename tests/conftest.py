@@ -0,0 +1,24 @@
+import asyncio
+
+import httpx
+import pytest
+import pytest_asyncio
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    """One event loop per session so the shared client can outlive a single test."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest_asyncio.fixture(scope="session")
+async def client():
+    """One in-process AsyncClient per session; the app lifespan runs once on entry."""
+    from app.main import app
+    
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as test_client:
+            yield test_client
@@ -1,46 +1,114 @@
+import anyio
+import json
 import pytest
-from fastapi.testclient import TestClient
+import time
+from datetime import datetime
+from decimal import Decimal
+import httpx
 from unittest.mock import Mock, patch
-from app.main import app
+from app.config import settings
+from app.main import app, health_cache, user_cache
+from app.models import QueryRequest
 
-client = TestClient(app)
+JOHN = {"ID": 1, "NAME": "John Doe", "EMAIL": "john@example.com", "CREATED_AT": datetime(2023, 1, 1)}
+JANE = {"ID": 2, "NAME": "Jane Smith", "EMAIL": "jane@example.com", "CREATED_AT": datetime(2023, 1, 2)}
+JOHN_UPDATED = {**JOHN, "NAME": "John Updated"}
+USER_NOT_FOUND = b'{"detail":"User not found"}'
+CONN_FAIL = RuntimeError("Connection failed")
+QUERY_FAIL = RuntimeError("Query failed")
+
+
+def _registration(user, created, message):
+    """Build a register_user_if_not_exists result."""
+    return {"user": user, "created": created, "message": message}
+
+
+@pytest.fixture
+def mock_db():
+    """Patch the module-level database used by the routes."""
+    with patch('app.main.snowflake_db', new_callable=Mock) as db:
+        yield db
+
+
+@pytest.fixture(autouse=True)
+def clear_read_caches():
+    """Keep cached reads from leaking between tests."""
+    health_cache.clear()
+    user_cache.clear()
+
+
+async def test_lifespan_sizes_threadpool():
+    """Test that startup sizes the worker thread pool used by sync routes."""
+    async with app.router.lifespan_context(app):
+        total_tokens = anyio.to_thread.current_default_thread_limiter().total_tokens
+    assert total_tokens == settings.threadpool_size
 
 
 class TestHealthEndpoints:
-    def test_health_check(self):
+    async def test_health_check(self, client):
         """Test the health check endpoint."""
-        response = client.get("/health")
+        response = await client.get("/health")
         assert response.status_code == 200
         data = response.json()
         assert data["status"] == "healthy"
         assert "timestamp" in data
         assert "version" in data
 
-    @patch('app.main.snowflake_db')
-    def test_database_health_check_success(self, mock_db):
+    @patch('app.main._health_response', (-1, None))
+    async def test_health_check_reuses_response_within_tick(self, client):
+        """Test that /health is rebuilt at most once per 100ms tick."""
+        with patch('app.main.time.monotonic_ns', return_value=1_000_000_000):
+            first = (await client.get("/health")).json()
+            with patch('app.main.HealthCheck', side_effect=AssertionError("rebuilt")):
+                second = (await client.get("/health")).json()
+        
+        assert first == second
+        assert first["timestamp"].endswith(("Z", "+00:00"))
+
+    @patch('app.main._health_response', (-1, None))
+    @patch('app.main.HealthCheck', side_effect=RuntimeError("boom"))
+    async def test_unhandled_exception_returns_error_response(self, mock_health):
+        """Test that unhandled errors are returned as a JSON ErrorResponse."""
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as error_client:
+            response = await error_client.get("/health")
+        assert response.status_code == 500
+        assert response.headers["content-type"] == "application/json"
+        data = response.json()
+        assert data["error"] == "Internal Server Error"
+        assert data["detail"] == "boom"
+        assert "timestamp" in data
+
+    async def test_database_health_check_success(self, mock_db, client):
         """Test database health check with successful connection."""
         mock_db.execute_query.return_value = [{"TEST": 1}]
         
-        response = client.get("/health/database")
+        response = await client.get("/health/database")
         assert response.status_code == 200
         data = response.json()
         assert data["status"] == "healthy"
         assert data["database"] == "connected"
 
-    @patch('app.main.snowflake_db')
-    def test_database_health_check_failure(self, mock_db):
+    async def test_database_health_check_failure(self, mock_db, client):
         """Test database health check with connection failure."""
-        mock_db.execute_query.side_effect = Exception("Connection failed")
+        mock_db.execute_query.side_effect = CONN_FAIL
         
-        response = client.get("/health/database")
+        response = await client.get("/health/database")
         assert response.status_code == 503
         data = response.json()
         assert "Database connection failed" in data["detail"]
 
+    async def test_database_health_check_cached(self, mock_db, client):
+        """Test that a healthy database check is reused within its TTL."""
+        mock_db.execute_query.return_value = [{"TEST": 1}]
+        
+        assert (await client.get("/health/database")).status_code == 200
+        assert (await client.get("/health/database")).status_code == 200
+        mock_db.execute_query.assert_called_once()
+
 
 class TestQueryEndpoint:
-    @patch('app.main.snowflake_db')
-    def test_execute_query_success(self, mock_db):
+    async def test_execute_query_success(self, mock_db, client):
         """Test successful query execution."""
         mock_result = [{"id": 1, "name": "test"}]
         mock_db.execute_query.return_value = mock_result
@@ -50,154 +118,327 @@ class TestQueryEndpoint:
             "parameters": None
         }
         
-        response = client.post("/query", json=query_data)
+        response = await client.post("/query", json=query_data)
         assert response.status_code == 200
         data = response.json()
         assert data["data"] == mock_result
         assert data["row_count"] == 1
         assert "execution_time_ms" in data
 
-    @patch('app.main.snowflake_db')
-    def test_execute_query_failure(self, mock_db):
+    async def test_execute_query_native_types(self, mock_db, client):
+        """Test that Snowflake NUMBER, BINARY and timestamp values serialize as before."""
+        mock_db.execute_query.return_value = [
+            {"AMOUNT": Decimal("1.50"), "CREATED_AT": datetime(2023, 1, 1, 12, 30), "ID": 10**20, "HASH": b"abc"}
+        ]
+        
+        query_data = {
+            "query": "SELECT amount, created_at, id, hash FROM orders"
+        }
+        
+        response = await client.post("/query", json=query_data)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json"
+        assert response.json()["data"] == [
+            {"AMOUNT": "1.50", "CREATED_AT": "2023-01-01T12:30:00", "ID": 10**20, "HASH": "abc"}
+        ]
+
+    async def test_execute_query_columnar_wide_integer(self, mock_db, client):
+        """Test that NUMBER(38,0) values beyond 64 bits serialize in columnar results."""
+        mock_db.execute_query_columnar.return_value = {"ID": [10**20]}
+        
+        response = await client.post("/query?format=columnar", json={"query": "SELECT id FROM t"})
+        assert response.status_code == 200
+        assert response.json()["data"] == {"ID": [10**20]}
+
+    async def test_execute_query_ndjson_native_types(self, mock_db, client):
+        """Test that wide integers, Decimal and BINARY values serialize in NDJSON rows."""
+        mock_db.iter_query_batches.return_value = iter([
+            [{"ID": 10**20, "AMOUNT": Decimal("1.50"), "HASH": b"abc"}]
+        ])
+        
+        response = await client.post("/query?format=ndjson", json={"query": "SELECT id FROM t"})
+        assert response.status_code == 200
+        assert json.loads(response.text) == {"ID": 10**20, "AMOUNT": "1.50", "HASH": "abc"}
+
+    async def test_execute_query_columnar(self, mock_db, client):
+        """Test returning query results column-major."""
+        mock_db.execute_query_columnar.return_value = {"id": [1, 2], "name": ["test", "other"]}
+        
+        query_data = {
+            "query": "SELECT * FROM test_table"
+        }
+        
+        response = await client.post("/query?format=columnar", json=query_data)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["columns"] == ["id", "name"]
+        assert data["data"] == {"id": [1, 2], "name": ["test", "other"]}
+        assert data["row_count"] == 2
+        mock_db.execute_query.assert_not_called()
+
+    async def test_execute_query_ndjson(self, mock_db, client):
+        """Test streaming query results as newline-delimited JSON."""
+        mock_db.iter_query_batches.return_value = iter([
+            [{"id": 1, "name": "test"}, {"id": 2, "name": "other"}],
+            [{"id": 3, "name": "third"}]
+        ])
+        
+        query_data = {
+            "query": "SELECT * FROM test_table"
+        }
+        
+        response = await client.post("/query?format=ndjson", json=query_data)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = response.text.splitlines()
+        assert [json.loads(line) for line in lines] == [
+            {"id": 1, "name": "test"},
+            {"id": 2, "name": "other"},
+            {"id": 3, "name": "third"}
+        ]
+        mock_db.execute_query.assert_not_called()
+
+    async def test_execute_query_arrow(self, mock_db, client):
+        """Test returning query results as an Arrow IPC stream."""
+        pa = pytest.importorskip("pyarrow")
+        table = pa.table({"id": [1, 2], "name": ["test", "other"]})
+        mock_db.execute_query_arrow.return_value = table
+        
+        query_data = {
+            "query": "SELECT * FROM test_table"
+        }
+        
+        response = await client.post("/query?format=arrow", json=query_data)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+        assert pa.ipc.open_stream(response.content).read_all().equals(table)
+
+    async def test_execute_query_gzip(self, mock_db, client):
+        """Test that large responses are gzip-compressed when the client accepts it."""
+        mock_db.execute_query.return_value = [{"id": i, "name": f"user {i}"} for i in range(100)]
+        
+        query_data = {
+            "query": "SELECT * FROM test_table"
+        }
+        
+        response = await client.post("/query", json=query_data, headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json()["row_count"] == 100
+
+    @pytest.mark.parametrize("query", [
+        "DELETE FROM users",
+        "DROP TABLE users",
+        "SELECT 1; DROP TABLE users",
+        "SELECT 'a;b'; DROP TABLE users",
+        "/* comment */ DELETE FROM users",
+        "-- SELECT\nDELETE FROM users",
+    ])
+    async def test_execute_query_rejects_non_read_only(self, mock_db, query, client):
+        """Test that only single read-only statements are accepted."""
+        response = await client.post("/query", json={"query": query})
+        assert response.status_code == 422
+        mock_db.execute_query.assert_not_called()
+
+    @pytest.mark.parametrize("tail", ["/* ", "'\\", '"', "$$ "])
+    def test_query_validation_is_linear(self, tail):
+        """Test that unterminated comments and literals don't make validation quadratic."""
+        query = "SELECT 1 " + tail * (99_000 // len(tail))
+        
+        start = time.perf_counter()
+        QueryRequest(query=query)
+        assert time.perf_counter() - start < 0.5
+
+    async def test_execute_query_rejects_oversized_query(self, mock_db, client):
+        """Test that queries over the length limit are rejected before reaching the database."""
+        response = await client.post("/query", json={"query": "SELECT 1 " + " " * 100_000})
+        assert response.status_code == 422
+        mock_db.execute_query.assert_not_called()
+
+    @pytest.mark.parametrize("query", [
+        "SELECT * FROM users WHERE name = 'a;b'",
+        "SELECT \"a;b\" FROM users",
+        "-- note\nSELECT 1",
+        "/* note */ WITH x AS (SELECT 1) SELECT * FROM x",
+        "(SELECT 1)",
+        "SELECT 1;",
+        "SELECT 1; -- done",
+    ])
+    async def test_execute_query_accepts_read_only(self, mock_db, query, client):
+        """Test that read-only statements with comments, parentheses or quoted ';' are accepted."""
+        mock_db.execute_query.return_value = []
+        
+        response = await client.post("/query", json={"query": query})
+        assert response.status_code == 200
+        mock_db.execute_query.assert_called_once()
+
+    async def test_execute_query_failure(self, mock_db, client):
         """Test query execution failure."""
-        mock_db.execute_query.side_effect = Exception("Query failed")
+        mock_db.execute_query.side_effect = QUERY_FAIL
         
         query_data = {
             "query": "SELECT * FROM invalid_table"
         }
         
-        response = client.post("/query", json=query_data)
+        response = await client.post("/query", json=query_data)
         assert response.status_code == 400
         data = response.json()
         assert "Query execution failed" in data["detail"]
 
 
 class TestUserEndpoints:
-    @patch('app.main.snowflake_db')
-    def test_get_users_success(self, mock_db):
+    async def test_get_users_success(self, mock_db, client):
         """Test getting users successfully."""
-        mock_users = [
-            {"ID": 1, "NAME": "John Doe", "EMAIL": "john@example.com", "CREATED_AT": "2023-01-01"},
-            {"ID": 2, "NAME": "Jane Smith", "EMAIL": "jane@example.com", "CREATED_AT": "2023-01-02"}
-        ]
-        mock_db.execute_query.return_value = mock_users
+        mock_db.execute_query.return_value = [JOHN, JANE]
         
-        response = client.get("/users")
+        response = await client.get("/users")
         assert response.status_code == 200
         data = response.json()
         assert len(data) == 2
         assert data[0]["name"] == "John Doe"
         assert data[1]["name"] == "Jane Smith"
+        assert data[0]["created_at"] == "2023-01-01T00:00:00"
 
-    @patch('app.main.snowflake_db')
-    def test_get_user_by_id_success(self, mock_db):
+    async def test_get_user_by_id_success(self, mock_db, client):
         """Test getting a specific user by ID."""
-        mock_user = [{"ID": 1, "NAME": "John Doe", "EMAIL": "john@example.com", "CREATED_AT": "2023-01-01"}]
-        mock_db.execute_query.return_value = mock_user
+        mock_db.execute_query.return_value = [JOHN]
         
-        response = client.get("/users/1")
+        response = await client.get("/users/1")
         assert response.status_code == 200
         data = response.json()
         assert data["id"] == 1
         assert data["name"] == "John Doe"
         assert data["email"] == "john@example.com"
 
-    @patch('app.main.snowflake_db')
-    def test_get_user_by_id_not_found(self, mock_db):
+    async def test_get_user_by_id_wide_integer(self, mock_db, client):
+        """Test that a user ID beyond 64 bits is returned intact."""
+        mock_db.execute_query.return_value = [{**JOHN, "ID": 10**20}]
+        
+        response = await client.get(f"/users/{10**20}")
+        assert response.status_code == 200
+        assert response.json()["id"] == 10**20
+
+    async def test_get_user_by_id_not_found(self, mock_db, client):
         """Test getting a user that doesn't exist."""
         mock_db.execute_query.return_value = []
         
-        response = client.get("/users/999")
+        response = await client.get("/users/999")
         assert response.status_code == 404
-        data = response.json()
-        assert data["detail"] == "User not found"
+        assert response.content == USER_NOT_FOUND
 
-    @patch('app.main.snowflake_db')
-    def test_create_user_success(self, mock_db):
-        """Test creating a new user."""
-        mock_created_user = [{"ID": 1, "NAME": "John Doe", "EMAIL": "john@example.com", "CREATED_AT": "2023-01-01"}]
+    async def test_get_user_by_id_cached(self, mock_db, client):
+        """Test that repeated reads of a user are served from the cache."""
+        mock_db.execute_query.return_value = [JOHN]
+        
+        assert (await client.get("/users/1")).status_code == 200
+        assert (await client.get("/users/1")).status_code == 200
+        mock_db.execute_query.assert_called_once()
+
+    async def test_update_user_invalidates_cache(self, mock_db, client):
+        """Test that updating a user drops the cached copy."""
+        mock_db.execute_query.return_value = [JOHN]
+        await client.get("/users/1")
+        
         mock_db.execute_non_query.return_value = 1
-        mock_db.execute_query.return_value = mock_created_user
+        mock_db.execute_query.return_value = [JOHN_UPDATED]
+        await client.put("/users/1", json={"name": "John Updated"})
+        
+        response = await client.get("/users/1")
+        assert response.json()["name"] == "John Updated"
+
+    async def test_register_user_update_invalidates_cache(self, mock_db, client):
+        """Test that registering an existing email with a new name drops the cached user."""
+        mock_db.execute_query.return_value = [JOHN]
+        await client.get("/users/1")
+        
+        mock_db.register_user_if_not_exists.return_value = {
+            **_registration(JOHN_UPDATED, False, "User already existed, name updated to John Updated"),
+            "updated": True
+        }
+        await client.post("/users/register", json={"name": "John Updated", "email": "john@example.com"})
+        
+        mock_db.execute_query.return_value = [JOHN_UPDATED]
+        response = await client.get("/users/1")
+        assert response.json()["name"] == "John Updated"
+
+    async def test_create_user_success(self, mock_db, client):
+        """Test creating a new user."""
+        mock_db.execute_returning.return_value = JOHN
         
         user_data = {
             "name": "John Doe",
             "email": "john@example.com"
         }
         
-        response = client.post("/users", json=user_data)
+        response = await client.post("/users", json=user_data)
         assert response.status_code == 200
         data = response.json()
         assert data["name"] == "John Doe"
         assert data["email"] == "john@example.com"
 
-    @patch('app.main.snowflake_db')
-    def test_update_user_success(self, mock_db):
-        """Test updating a user."""
-        mock_updated_user = [{"ID": 1, "NAME": "John Updated", "EMAIL": "john.updated@example.com", "CREATED_AT": "2023-01-01"}]
-        mock_db.execute_non_query.return_value = 1
-        mock_db.execute_query.return_value = mock_updated_user
+    @pytest.mark.parametrize("method,url,affected,status,expected", [
+        ("PUT", "/users/1", 1, 200, b'"name":"John Updated"'),
+        ("PUT", "/users/999", 0, 404, USER_NOT_FOUND),
+        ("DELETE", "/users/1", 1, 200, b"deleted successfully"),
+        ("DELETE", "/users/999", 0, 404, USER_NOT_FOUND),
+    ])
+    async def test_user_mutation(self, mock_db, client, method, url, affected, status, expected):
+        """Test updating and deleting users that do and don't exist."""
+        mock_db.execute_non_query.return_value = affected
+        mock_db.execute_query.return_value = [JOHN_UPDATED]
         
-        update_data = {
-            "name": "John Updated",
-            "email": "john.updated@example.com"
-        }
-        
-        response = client.put("/users/1", json=update_data)
-        assert response.status_code == 200
-        data = response.json()
-        assert data["name"] == "John Updated"
-        assert data["email"] == "john.updated@example.com"
-
-    @patch('app.main.snowflake_db')
-    def test_update_user_not_found(self, mock_db):
-        """Test updating a user that doesn't exist."""
-        mock_db.execute_non_query.return_value = 0
-        
-        update_data = {
-            "name": "John Updated"
-        }
-        
-        response = client.put("/users/999", json=update_data)
-        assert response.status_code == 404
-        data = response.json()
-        assert data["detail"] == "User not found"
+        response = await client.request(method, url, json={"name": "John Updated"})
+        assert response.status_code == status
+        assert expected in response.content
 
-    @patch('app.main.snowflake_db')
-    def test_delete_user_success(self, mock_db):
-        """Test deleting a user."""
+    async def test_update_user_partial_uses_fixed_statement(self, mock_db, client):
+        """Test that a partial update binds omitted fields as NULL."""
         mock_db.execute_non_query.return_value = 1
+        mock_db.execute_query.return_value = [JOHN_UPDATED]
         
-        response = client.delete("/users/1")
+        response = await client.put("/users/1", json={"name": "John Updated"})
         assert response.status_code == 200
-        data = response.json()
-        assert "deleted successfully" in data["message"]
+        
+        query, params = mock_db.execute_non_query.call_args.args
+        assert "COALESCE(%(name)s, name)" in query
+        assert "COALESCE(%(email)s, email)" in query
+        assert params == {"user_id": 1, "name": "John Updated", "email": None}
 
-    @patch('app.main.snowflake_db')
-    def test_delete_user_not_found(self, mock_db):
-        """Test deleting a user that doesn't exist."""
-        mock_db.execute_non_query.return_value = 0
+    async def test_update_user_no_fields(self, mock_db, client):
+        """Test that an update with no fields is rejected."""
+        response = await client.put("/users/1", json={})
+        assert response.status_code == 400
+        mock_db.execute_non_query.assert_not_called()
+
+    async def test_bulk_create_users(self, mock_db, client):
+        """Test creating many users in one request."""
+        mock_db.bulk_insert_users.return_value = 2
         
-        response = client.delete("/users/999")
-        assert response.status_code == 404
-        data = response.json()
-        assert data["detail"] == "User not found"
+        users_data = [
+            {"name": "John Doe", "email": "john@example.com"},
+            {"name": "Jane Smith", "email": "jane@example.com"}
+        ]
+        
+        response = await client.post("/users/bulk", json=users_data)
+        assert response.status_code == 200
+        assert response.json() == {"inserted": 2}
+        mock_db.bulk_insert_users.assert_called_once_with([
+            ("John Doe", "john@example.com"),
+            ("Jane Smith", "jane@example.com")
+        ])
 
-    @patch('app.main.snowflake_db')
-    def test_register_user_new(self, mock_db):
+    async def test_register_user_new(self, mock_db, client):
         """Test registering a new user."""
-        mock_result = {
-            "user": {"ID": 1, "NAME": "John Doe", "EMAIL": "john@example.com", "CREATED_AT": "2023-01-01"},
-            "created": True,
-            "message": "New user created with email john@example.com"
-        }
-        mock_db.register_user_if_not_exists.return_value = mock_result
+        mock_db.register_user_if_not_exists.return_value = _registration(
+            JOHN, True, "New user created with email john@example.com"
+        )
         
         user_data = {
             "name": "John Doe",
             "email": "john@example.com"
         }
         
-        response = client.post("/users/register", json=user_data)
+        response = await client.post("/users/register", json=user_data)
         assert response.status_code == 200
         data = response.json()
         assert data["user"]["name"] == "John Doe"
@@ -205,22 +446,18 @@ class TestUserEndpoints:
         assert data["created"] is True
         assert "New user created" in data["message"]
 
-    @patch('app.main.snowflake_db')
-    def test_register_user_existing(self, mock_db):
+    async def test_register_user_existing(self, mock_db, client):
         """Test registering an existing user."""
-        mock_result = {
-            "user": {"ID": 1, "NAME": "John Doe", "EMAIL": "john@example.com", "CREATED_AT": "2023-01-01"},
-            "created": False,
-            "message": "User already exists with email john@example.com"
-        }
-        mock_db.register_user_if_not_exists.return_value = mock_result
+        mock_db.register_user_if_not_exists.return_value = _registration(
+            JOHN, False, "User already exists with email john@example.com"
+        )
         
         user_data = {
             "name": "John Doe",
             "email": "john@example.com"
         }
         
-        response = client.post("/users/register", json=user_data)
+        response = await client.post("/users/register", json=user_data)
         assert response.status_code == 200
         data = response.json()
         assert data["user"]["name"] == "John Doe"
@@ -228,22 +465,18 @@ class TestUserEndpoints:
         assert data["created"] is False
         assert "already exists" in data["message"]
 
-    @patch('app.main.snowflake_db')
-    def test_register_user_update_name(self, mock_db):
+    async def test_register_user_update_name(self, mock_db, client):
         """Test registering a user with updated name."""
-        mock_result = {
-            "user": {"ID": 1, "NAME": "John Updated", "EMAIL": "john@example.com", "CREATED_AT": "2023-01-01"},
-            "created": False,
-            "message": "User already existed, name updated to John Updated"
-        }
-        mock_db.register_user_if_not_exists.return_value = mock_result
+        mock_db.register_user_if_not_exists.return_value = _registration(
+            JOHN_UPDATED, False, "User already existed, name updated to John Updated"
+        )
         
         user_data = {
             "name": "John Updated",
             "email": "john@example.com"
         }
         
-        response = client.post("/users/register", json=user_data)
+        response = await client.post("/users/register", json=user_data)
         assert response.status_code == 200
         data = response.json()
         assert data["user"]["name"] == "John Updated"
@@ -0,0 +1,27 @@
+"""
+Micro-benchmarks for hot request paths.
+
+These run as ordinary tests (once, untimed) under the default
+``--benchmark-disable``; see the README for timing and comparing them.
+"""
+from unittest.mock import Mock, patch
+from app.database import SnowflakeConnection
+
+
+def test_health_round_trip(benchmark, client, event_loop):
+    """Benchmark a /health request through the full middleware stack."""
+    response = benchmark(lambda: event_loop.run_until_complete(client.get("/health")))
+    assert response.status_code == 200
+
+
+def test_execute_query_mocked(benchmark):
+    """Benchmark execute_query overhead (pool checkout, cursor) against a mock connection."""
+    cursor = Mock()
+    cursor.fetchall.return_value = [{"1": 1}]
+    connection = Mock()
+    connection.cursor.return_value = cursor
+    
+    with patch('snowflake.connector.connect', return_value=connection), \
+         patch('app.database.secrets_manager'):
+        db = SnowflakeConnection()
+        assert benchmark(db.execute_query, "SELECT 1") == [{"1": 1}]
@@ -1,87 +1,144 @@
+import subprocess
+import sys
 import pytest
-from unittest.mock import Mock, patch, MagicMock
+from datetime import datetime
+from unittest.mock import Mock, patch
 from app.database import SnowflakeConnection
-import snowflake.connector
+
+_MINIMAL_CREDS = {"account": "test"}
+_FULL_CREDS = {
+    "account": "test_account",
+    "user": "test_user",
+    "password": "test_password",
+    "warehouse": "test_warehouse",
+    "database": "test_database",
+    "schema": "test_schema",
+    "role": "test_role"
+}
+_JOHN_ROW = {"ID": 1, "NAME": "John Doe", "EMAIL": "john@example.com", "CREATED_AT": datetime(2023, 1, 1)}
+_JOHN_UPDATED_ROW = {**_JOHN_ROW, "NAME": "John Updated"}
+_SECRET_FAIL = RuntimeError("Secret not found")
+
+
+@pytest.fixture(scope="session")
+def connector():
+    """Import the Snowflake connector only on workers that run these tests."""
+    import snowflake.connector.errors
+    return snowflake.connector
+
+
+def test_app_import_defers_heavy_modules():
+    """Test that importing the app doesn't load the Snowflake connector or boto3."""
+    script = (
+        "import sys, app.main; "
+        "loaded = [m for m in ('snowflake.connector', 'boto3', 'sqlalchemy', 'pyarrow') if m in sys.modules]; "
+        "assert not loaded, loaded"
+    )
+    subprocess.run([sys.executable, "-c", script], check=True)
 
 
 class TestSnowflakeConnection:
-    def setup_method(self):
-        """Set up test fixtures."""
+    @pytest.fixture(autouse=True)
+    def _db(self):
+        """Give each test its own instance; the connection pool is per instance."""
         self.db = SnowflakeConnection()
 
-    @patch('app.database.secrets_manager')
-    def test_get_credentials_success(self, mock_secrets):
+    @pytest.fixture(autouse=True)
+    def _patches(self):
+        """Patch the connector and secrets; connect() hands out one shared mock connection and cursor."""
+        with patch('snowflake.connector.connect', new_callable=Mock) as mock_connect, \
+             patch('app.database.secrets_manager', new_callable=Mock) as mock_secrets:
+            mock_secrets.get_snowflake_credentials.return_value = _MINIMAL_CREDS
+            self.mock_cursor = Mock()
+            self.mock_connection = Mock()
+            self.mock_connection.cursor.return_value = self.mock_cursor
+            mock_connect.return_value = self.mock_connection
+            self.mock_connect = mock_connect
+            self.mock_secrets = mock_secrets
+            yield
+
+    def test_get_credentials_success(self):
         """Test successful credential retrieval."""
-        mock_credentials = {
-            "account": "test_account",
-            "user": "test_user",
-            "password": "test_password",
-            "warehouse": "test_warehouse",
-            "database": "test_database",
-            "schema": "test_schema",
-            "role": "test_role"
-        }
-        mock_secrets.get_snowflake_credentials.return_value = mock_credentials
+        self.mock_secrets.get_snowflake_credentials.return_value = _FULL_CREDS
         
         credentials = self.db._get_credentials()
-        assert credentials == mock_credentials
-        mock_secrets.get_snowflake_credentials.assert_called_once()
+        assert credentials == _FULL_CREDS
+        self.mock_secrets.get_snowflake_credentials.assert_called_once()
 
-    @patch('app.database.secrets_manager')
-    def test_get_credentials_failure(self, mock_secrets):
+    def test_get_credentials_failure(self):
         """Test credential retrieval failure."""
-        mock_secrets.get_snowflake_credentials.side_effect = Exception("Secret not found")
+        self.mock_secrets.get_snowflake_credentials.side_effect = _SECRET_FAIL
         
         with pytest.raises(Exception) as exc_info:
             self.db._get_credentials()
         
         assert "Secret not found" in str(exc_info.value)
 
-    @patch('app.database.snowflake.connector.connect')
-    @patch('app.database.secrets_manager')
-    def test_get_connection_success(self, mock_secrets, mock_connect):
+    def test_get_connection_success(self):
         """Test successful database connection."""
-        mock_credentials = {
-            "account": "test_account",
-            "user": "test_user",
-            "password": "test_password",
-            "warehouse": "test_warehouse",
-            "database": "test_database",
-            "schema": "test_schema",
-            "role": "test_role"
-        }
-        mock_secrets.get_snowflake_credentials.return_value = mock_credentials
-        mock_connection = MagicMock()
-        mock_connect.return_value = mock_connection
+        self.mock_secrets.get_snowflake_credentials.return_value = _FULL_CREDS
         
         with self.db.get_connection() as conn:
-            assert conn == mock_connection
-            mock_connect.assert_called_once_with(
+            assert conn == self.mock_connection
+            self.mock_connect.assert_called_once_with(
                 account="test_account",
                 user="test_user",
                 password="test_password",
                 warehouse="test_warehouse",
                 database="test_database",
                 schema="test_schema",
-                role="test_role"
+                role="test_role",
+                session_parameters={"USE_CACHED_RESULT": True},
+                client_session_keep_alive=True
             )
+
+        # Connection is returned to the pool, not closed
+        self.mock_connection.close.assert_not_called()
+
+    def test_get_connection_reuses_pooled_connection(self):
+        """Test that sequential borrows reuse the same pooled connection."""
+        with self.db.get_connection() as first:
+            pass
+        with self.db.get_connection() as second:
+            pass
+
+        assert first is second
+        self.mock_connect.assert_called_once()
+        self.mock_connection.rollback.assert_not_called()
+
+    def test_get_connection_replaces_expired_session(self, connector):
+        """Test that a session-expired error drops the connection from the pool."""
+        self.mock_connection.is_closed.return_value = False
+        expired = connector.errors.ProgrammingError(
+            msg="Session no longer exists", errno=390112, sqlstate="08001"
+        )
         
-        mock_connection.close.assert_called_once()
+        with pytest.raises(connector.errors.ProgrammingError):
+            with self.db.get_connection():
+                raise expired
+        with self.db.get_connection():
+            pass
+        
+        assert self.mock_connect.call_count == 2
 
-    @patch('app.database.snowflake.connector.connect')
-    @patch('app.database.secrets_manager')
-    def test_execute_query_success(self, mock_secrets, mock_connect):
-        """Test successful query execution."""
-        mock_credentials = {"account": "test"}
-        mock_secrets.get_snowflake_credentials.return_value = mock_credentials
+    def test_get_connection_keeps_live_connection_after_query_error(self, connector):
+        """Test that an ordinary query error returns the connection to the pool."""
+        self.mock_connection.is_closed.return_value = False
         
-        mock_cursor = MagicMock()
-        mock_cursor.description = [("ID",), ("NAME",)]
-        mock_cursor.fetchall.return_value = [(1, "John"), (2, "Jane")]
+        with pytest.raises(connector.errors.ProgrammingError):
+            with self.db.get_connection():
+                raise connector.errors.ProgrammingError(msg="SQL compilation error", errno=1003)
+        with self.db.get_connection():
+            pass
         
-        mock_connection = MagicMock()
-        mock_connection.cursor.return_value = mock_cursor
-        mock_connect.return_value = mock_connection
+        self.mock_connect.assert_called_once()
+
+    def test_execute_query_success(self, connector):
+        """Test successful query execution."""
+        self.mock_cursor.fetchall.return_value = [
+            {"ID": 1, "NAME": "John"},
+            {"ID": 2, "NAME": "Jane"}
+        ]
         
         result = self.db.execute_query("SELECT * FROM users")
         
@@ -90,66 +147,180 @@ class TestSnowflakeConnection:
             {"ID": 2, "NAME": "Jane"}
         ]
         assert result == expected_result
-        mock_cursor.execute.assert_called_once_with("SELECT * FROM users")
-        mock_cursor.close.assert_called_once()
+        self.mock_connection.cursor.assert_called_once_with(connector.DictCursor)
+        self.mock_cursor.execute.assert_called_once_with("SELECT * FROM users")
+        self.mock_cursor.close.assert_called_once()
 
-    @patch('app.database.snowflake.connector.connect')
-    @patch('app.database.secrets_manager')
-    def test_execute_query_with_params(self, mock_secrets, mock_connect):
+    def test_execute_query_with_params(self):
         """Test query execution with parameters."""
-        mock_credentials = {"account": "test"}
-        mock_secrets.get_snowflake_credentials.return_value = mock_credentials
-        
-        mock_cursor = MagicMock()
-        mock_cursor.description = [("ID",), ("NAME",)]
-        mock_cursor.fetchall.return_value = [(1, "John")]
-        
-        mock_connection = MagicMock()
-        mock_connection.cursor.return_value = mock_cursor
-        mock_connect.return_value = mock_connection
+        self.mock_cursor.fetchall.return_value = [{"ID": 1, "NAME": "John"}]
         
         params = {"user_id": 1}
         result = self.db.execute_query("SELECT * FROM users WHERE id = %(user_id)s", params)
         
-        mock_cursor.execute.assert_called_once_with("SELECT * FROM users WHERE id = %(user_id)s", params)
+        self.mock_cursor.execute.assert_called_once_with("SELECT * FROM users WHERE id = %(user_id)s", params)
         assert len(result) == 1
         assert result[0]["ID"] == 1
 
-    @patch('app.database.snowflake.connector.connect')
-    @patch('app.database.secrets_manager')
-    def test_execute_non_query_success(self, mock_secrets, mock_connect):
-        """Test successful non-query execution."""
-        mock_credentials = {"account": "test"}
-        mock_secrets.get_snowflake_credentials.return_value = mock_credentials
+    def test_iter_query_batches(self):
+        """Test streaming query results batch by batch."""
+        self.mock_cursor.fetchmany.side_effect = [
+            [{"ID": 1, "NAME": "John"}, {"ID": 2, "NAME": "Jane"}],
+            [{"ID": 3, "NAME": "Bob"}],
+            []
+        ]
+        
+        result = list(self.db.iter_query_batches("SELECT * FROM users", batch_size=2))
+        
+        assert [[row["ID"] for row in batch] for batch in result] == [[1, 2], [3]]
+        assert self.mock_cursor.arraysize == 2
+        self.mock_cursor.fetchmany.assert_called_with(2)
+        self.mock_cursor.fetchall.assert_not_called()
+        self.mock_cursor.close.assert_called_once()
+
+    def test_execute_query_arrow(self):
+        """Test fetching query results as an Arrow table."""
+        pa = pytest.importorskip("pyarrow")
+        
+        table = pa.table({"ID": [1, 2], "NAME": ["John", "Jane"]})
+        self.mock_cursor.fetch_arrow_all.return_value = table
+        
+        result = self.db.execute_query_arrow("SELECT * FROM users")
+        
+        assert result is table
+        self.mock_cursor.execute.assert_called_once_with("SELECT * FROM users")
+        self.mock_cursor.close.assert_called_once()
+
+    def test_execute_query_arrow_empty_result(self):
+        """Test that an empty Arrow result keeps its column names."""
+        pytest.importorskip("pyarrow")
+        
+        self.mock_cursor.fetch_arrow_all.return_value = None
+        self.mock_cursor.description = [("ID",), ("NAME",)]
+        
+        result = self.db.execute_query_arrow("SELECT * FROM users WHERE 1 = 0")
         
-        mock_cursor = MagicMock()
-        mock_cursor.rowcount = 1
+        assert result.column_names == ["ID", "NAME"]
+        assert result.num_rows == 0
+
+    @patch('app.database._HAS_PYARROW', False)
+    def test_execute_query_arrow_requires_pyarrow(self):
+        """Test that Arrow results fail clearly without pyarrow installed."""
+        with pytest.raises(RuntimeError) as exc_info:
+            self.db.execute_query_arrow("SELECT 1")
+        
+        assert "pyarrow" in str(exc_info.value)
+
+    def test_execute_query_columnar_from_arrow(self):
+        """Test that columnar results come from the Arrow table when available."""
+        pa = pytest.importorskip("pyarrow")
+        table = pa.table({"ID": [1, 2], "NAME": ["John", "Jane"]})
+        
+        with patch.object(self.db, 'execute_query_arrow', return_value=table) as mock_arrow:
+            result = self.db.execute_query_columnar("SELECT * FROM users")
         
-        mock_connection = MagicMock()
-        mock_connection.cursor.return_value = mock_cursor
-        mock_connect.return_value = mock_connection
+        assert result == {"ID": [1, 2], "NAME": ["John", "Jane"]}
+        mock_arrow.assert_called_once_with("SELECT * FROM users", None)
+
+    @patch('app.database._HAS_PYARROW', False)
+    def test_execute_query_columnar_without_pyarrow(self):
+        """Test that columnar results fall back to transposing row tuples."""
+        self.mock_cursor.fetchall.return_value = [(1, "John"), (2, "Jane")]
+        self.mock_cursor.description = [("ID",), ("NAME",)]
+        
+        result = self.db.execute_query_columnar("SELECT * FROM users")
+        
+        assert result == {"ID": [1, 2], "NAME": ["John", "Jane"]}
+        self.mock_cursor.close.assert_called_once()
+
+    @patch('app.database._HAS_PYARROW', False)
+    def test_execute_query_columnar_without_pyarrow_empty_result(self):
+        """Test that an empty columnar result keeps its column names without pyarrow."""
+        self.mock_cursor.fetchall.return_value = []
+        self.mock_cursor.description = [("ID",), ("NAME",)]
+        
+        result = self.db.execute_query_columnar("SELECT * FROM users WHERE 1 = 0")
+        
+        assert result == {"ID": [], "NAME": []}
+
+    def test_execute_non_query_success(self):
+        """Test successful non-query execution."""
+        self.mock_cursor.rowcount = 1
         
         affected_rows = self.db.execute_non_query("INSERT INTO users (name) VALUES ('John')")
         
         assert affected_rows == 1
-        mock_cursor.execute.assert_called_once_with("INSERT INTO users (name) VALUES ('John')")
-        mock_cursor.close.assert_called_once()
+        self.mock_cursor.execute.assert_called_once_with("INSERT INTO users (name) VALUES ('John')")
+        self.mock_cursor.close.assert_called_once()
 
-    @patch('app.database.snowflake.connector.connect')
-    @patch('app.database.secrets_manager')
-    def test_register_user_if_not_exists_new_user(self, mock_secrets, mock_connect):
-        """Test registering a new user that doesn't exist."""
-        mock_credentials = {"account": "test"}
-        mock_secrets.get_snowflake_credentials.return_value = mock_credentials
+    def test_execute_returning(self):
+        """Test running a statement and reading the row back on one cursor."""
+        self.mock_cursor.fetchone.return_value = {"ID": 1, "NAME": "John"}
+        
+        params = {"name": "John"}
+        result = self.db.execute_returning(
+            "INSERT INTO users (name) VALUES (%(name)s)",
+            "SELECT id, name FROM users WHERE name = %(name)s",
+            params
+        )
+        
+        assert result == {"ID": 1, "NAME": "John"}
+        assert [c.args for c in self.mock_cursor.execute.call_args_list] == [
+            ("INSERT INTO users (name) VALUES (%(name)s)", params),
+            ("SELECT id, name FROM users WHERE name = %(name)s", params)
+        ]
+        self.mock_connect.assert_called_once()
+        self.mock_cursor.close.assert_called_once()
+
+    def test_bulk_insert_users(self):
+        """Test inserting many users through one MERGE that skips existing emails."""
+        self.mock_cursor.fetchone.return_value = {"number of rows inserted": 2}
+        
+        users = [
+            ("John Doe", "john@example.com"),
+            ("Jane Smith", "jane@example.com"),
+            ("Johnny", "john@example.com")
+        ]
+        inserted = self.db.bulk_insert_users(users)
         
-        mock_cursor = MagicMock()
-        # First call (check if user exists) - no results
-        mock_cursor.fetchone.side_effect = [None, (1, "John Doe", "john@example.com", "2023-01-01")]
-        mock_cursor.description = [("ID",), ("NAME",), ("EMAIL",), ("CREATED_AT",)]
+        assert inserted == 2
+        query, params = self.mock_cursor.execute.call_args.args
+        assert "MERGE INTO users" in query
+        assert "WHEN NOT MATCHED THEN INSERT" in query
+        assert "WHEN MATCHED THEN" not in query
+        # Duplicate emails in the payload keep their first name
+        assert params == ["John Doe", "john@example.com", "Jane Smith", "jane@example.com"]
+        self.mock_cursor.execute.assert_called_once()
+        self.mock_cursor.close.assert_called_once()
+
+    @patch('app.database._BULK_INSERT_CHUNK_SIZE', 2)
+    def test_bulk_insert_users_chunks_large_payloads(self):
+        """Test that large payloads are merged in bounded chunks over one connection."""
+        self.mock_cursor.fetchone.side_effect = [
+            {"number of rows inserted": 2},
+            {"number of rows inserted": 1}
+        ]
         
-        mock_connection = MagicMock()
-        mock_connection.cursor.return_value = mock_cursor
-        mock_connect.return_value = mock_connection
+        users = [(f"User {i}", f"user{i}@example.com") for i in range(3)]
+        inserted = self.db.bulk_insert_users(users)
+        
+        assert inserted == 3
+        assert self.mock_cursor.execute.call_count == 2
+        assert self.mock_cursor.execute.call_args.args[1] == ["User 2", "user2@example.com"]
+        self.mock_connect.assert_called_once()
+
+    def test_bulk_insert_users_empty(self):
+        """Test that an empty bulk insert doesn't touch the database."""
+        assert self.db.bulk_insert_users([]) == 0
+        self.mock_connect.assert_not_called()
+
+    def test_register_user_if_not_exists_new_user(self):
+        """Test registering a new user that doesn't exist."""
+        # MERGE inserted a row, then the user is read back
+        self.mock_cursor.fetchone.side_effect = [
+            {"number of rows inserted": 1, "number of rows updated": 0},
+            _JOHN_ROW
+        ]
         
         result = self.db.register_user_if_not_exists("John Doe", "john@example.com")
         
@@ -158,22 +329,17 @@ class TestSnowflakeConnection:
         assert result["user"]["NAME"] == "John Doe"
         assert result["user"]["EMAIL"] == "john@example.com"
         assert "New user created" in result["message"]
+        # One MERGE and one SELECT, regardless of outcome
+        assert self.mock_cursor.execute.call_count == 2
+        assert "MERGE INTO users" in self.mock_cursor.execute.call_args_list[0].args[0]
 
-    @patch('app.database.snowflake.connector.connect')
-    @patch('app.database.secrets_manager')
-    def test_register_user_if_not_exists_existing_user(self, mock_secrets, mock_connect):
+    def test_register_user_if_not_exists_existing_user(self):
         """Test registering a user that already exists with same name."""
-        mock_credentials = {"account": "test"}
-        mock_secrets.get_snowflake_credentials.return_value = mock_credentials
-        
-        mock_cursor = MagicMock()
-        # User already exists with same name
-        mock_cursor.fetchone.return_value = (1, "John Doe", "john@example.com", "2023-01-01")
-        mock_cursor.description = [("ID",), ("NAME",), ("EMAIL",), ("CREATED_AT",)]
-        
-        mock_connection = MagicMock()
-        mock_connection.cursor.return_value = mock_cursor
-        mock_connect.return_value = mock_connection
+        # User already exists with same name, so MERGE touched nothing
+        self.mock_cursor.fetchone.side_effect = [
+            {"number of rows inserted": 0, "number of rows updated": 0},
+            _JOHN_ROW
+        ]
         
         result = self.db.register_user_if_not_exists("John Doe", "john@example.com")
         
@@ -183,24 +349,13 @@ class TestSnowflakeConnection:
         assert result["user"]["EMAIL"] == "john@example.com"
         assert "already exists" in result["message"]
 
-    @patch('app.database.snowflake.connector.connect')
-    @patch('app.database.secrets_manager')
-    def test_register_user_if_not_exists_update_name(self, mock_secrets, mock_connect):
+    def test_register_user_if_not_exists_update_name(self):
         """Test registering a user that exists but with different name."""
-        mock_credentials = {"account": "test"}
-        mock_secrets.get_snowflake_credentials.return_value = mock_credentials
-        
-        mock_cursor = MagicMock()
-        # First call - user exists with old name, second call - user with updated name
-        mock_cursor.fetchone.side_effect = [
-            (1, "John Old", "john@example.com", "2023-01-01"),
-            (1, "John Updated", "john@example.com", "2023-01-01")
+        # MERGE updated the existing user's name, then the user is read back
+        self.mock_cursor.fetchone.side_effect = [
+            {"number of rows inserted": 0, "number of rows updated": 1},
+            _JOHN_UPDATED_ROW
         ]
-        mock_cursor.description = [("ID",), ("NAME",), ("EMAIL",), ("CREATED_AT",)]
-        
-        mock_connection = MagicMock()
-        mock_connection.cursor.return_value = mock_cursor
-        mock_connect.return_value = mock_connection
         
         result = self.db.register_user_if_not_exists("John Updated", "john@example.com")
         
@@ -1,109 +1,122 @@
+import sys
+import types
 import pytest
 from unittest.mock import Mock, patch
-from app.secrets import SecretsManager, secrets_manager
+from app.secrets import SecretsManager, secrets_manager, _get_client
 from botocore.exceptions import ClientError
 
 
 class TestSecretsManager:
-    @patch('app.secrets.boto3.client')
-    def setup_method(self, mock_boto_client):
-        """Set up test fixtures."""
-        self.mock_client = Mock()
-        mock_boto_client.return_value = self.mock_client
-        self.secrets_mgr = SecretsManager()
+    @pytest.fixture(autouse=True)
+    def setup_client(self):
+        """Set up test fixtures; a stub boto3 module stays in place because the client is built lazily."""
+        _get_client.cache_clear()
+        boto3_stub = types.ModuleType("boto3")
+        boto3_stub.client = Mock()
+        with patch.dict(sys.modules, {"boto3": boto3_stub}):
+            self.mock_boto_client = boto3_stub.client
+            self.mock_client = Mock()
+            boto3_stub.client.return_value = self.mock_client
+            self.secrets_mgr = SecretsManager()
+            yield
+        _get_client.cache_clear()
 
-    @patch('app.secrets.boto3.client')
-    def test_get_secret_success(self, mock_boto_client):
+    def test_client_shared_between_instances(self):
+        """Test that the boto3 client is built once and shared."""
+        first = SecretsManager()
+        second = SecretsManager()
+        
+        assert first.client is second.client
+        self.mock_boto_client.assert_called_once()
+        config = self.mock_boto_client.call_args.kwargs["config"]
+        assert config.retries == {'mode': 'adaptive'}
+        assert config.max_pool_connections == 50
+
+    def test_get_secret_success(self):
         """Test successful secret retrieval."""
-        mock_client = Mock()
-        mock_boto_client.return_value = mock_client
-        
         mock_response = {
             'SecretString': '{"username": "test_user", "password": "test_password"}'
         }
-        mock_client.get_secret_value.return_value = mock_response
+        self.mock_client.get_secret_value.return_value = mock_response
         
-        secrets_mgr = SecretsManager()
-        result = secrets_mgr.get_secret("test-secret")
+        result = self.secrets_mgr.get_secret("test-secret")
         
         expected_result = {"username": "test_user", "password": "test_password"}
         assert result == expected_result
-        mock_client.get_secret_value.assert_called_once_with(SecretId="test-secret")
+        self.mock_client.get_secret_value.assert_called_once_with(SecretId="test-secret")
 
-    @patch('app.secrets.boto3.client')
-    def test_get_secret_not_found(self, mock_boto_client):
-        """Test secret not found error."""
-        mock_client = Mock()
-        mock_boto_client.return_value = mock_client
-        
-        error_response = {'Error': {'Code': 'ResourceNotFoundException'}}
-        mock_client.get_secret_value.side_effect = ClientError(error_response, 'GetSecretValue')
+    @pytest.mark.parametrize("code,msg", [
+        ("ResourceNotFoundException", "was not found"),
+        ("DecryptionFailureException", "can't decrypt"),
+        ("InternalServiceErrorException", "server side"),
+        ("InvalidParameterException", "invalid value"),
+        ("InvalidRequestException", "not valid for the current state"),
+    ])
+    def test_get_secret_error(self, code, msg):
+        """Test that Secrets Manager error codes map to readable errors."""
+        error_response = {'Error': {'Code': code}}
+        self.mock_client.get_secret_value.side_effect = ClientError(error_response, 'GetSecretValue')
         
-        secrets_mgr = SecretsManager()
         with pytest.raises(Exception) as exc_info:
-            secrets_mgr.get_secret("non-existent-secret")
+            self.secrets_mgr.get_secret("test-secret")
         
-        assert "was not found" in str(exc_info.value)
+        assert msg in str(exc_info.value)
 
-    @patch('app.secrets.boto3.client')
-    def test_get_secret_decryption_failure(self, mock_boto_client):
-        """Test decryption failure error."""
-        mock_client = Mock()
-        mock_boto_client.return_value = mock_client
+    def test_get_secret_cached(self):
+        """Test that a fresh secret is served from the cache."""
+        self.mock_client.get_secret_value.return_value = {'SecretString': '{"password": "p1"}'}
         
-        error_response = {'Error': {'Code': 'DecryptionFailureException'}}
-        mock_client.get_secret_value.side_effect = ClientError(error_response, 'GetSecretValue')
-        
-        secrets_mgr = SecretsManager()
-        with pytest.raises(Exception) as exc_info:
-            secrets_mgr.get_secret("test-secret")
+        first = self.secrets_mgr.get_secret("test-secret")
+        second = self.secrets_mgr.get_secret("test-secret")
         
-        assert "can't decrypt" in str(exc_info.value)
+        assert first == second == {"password": "p1"}
+        self.mock_client.get_secret_value.assert_called_once_with(SecretId="test-secret")
 
-    @patch('app.secrets.boto3.client')
-    def test_get_secret_internal_error(self, mock_boto_client):
-        """Test internal service error."""
-        mock_client = Mock()
-        mock_boto_client.return_value = mock_client
-        
-        error_response = {'Error': {'Code': 'InternalServiceErrorException'}}
-        mock_client.get_secret_value.side_effect = ClientError(error_response, 'GetSecretValue')
-        
-        secrets_mgr = SecretsManager()
-        with pytest.raises(Exception) as exc_info:
-            secrets_mgr.get_secret("test-secret")
-        
-        assert "server side" in str(exc_info.value)
+    @patch('app.secrets.settings')
+    def test_get_secret_refreshes_after_ttl(self, mock_settings):
+        """Test that an expired secret is fetched again."""
+        mock_settings.secret_cache_ttl_seconds = 0
+        self.mock_client.get_secret_value.side_effect = [
+            {'SecretString': '{"password": "p1"}'},
+            {'SecretString': '{"password": "p2"}'}
+        ]
+        
+        assert self.secrets_mgr.get_secret("test-secret") == {"password": "p1"}
+        assert self.secrets_mgr.get_secret("test-secret") == {"password": "p2"}
+        assert self.mock_client.get_secret_value.call_count == 2
 
-    @patch('app.secrets.boto3.client')
-    def test_get_secret_invalid_parameter(self, mock_boto_client):
-        """Test invalid parameter error."""
-        mock_client = Mock()
-        mock_boto_client.return_value = mock_client
-        
-        error_response = {'Error': {'Code': 'InvalidParameterException'}}
-        mock_client.get_secret_value.side_effect = ClientError(error_response, 'GetSecretValue')
-        
-        secrets_mgr = SecretsManager()
-        with pytest.raises(Exception) as exc_info:
-            secrets_mgr.get_secret("test-secret")
-        
-        assert "invalid value" in str(exc_info.value)
+    @patch('app.secrets.settings')
+    def test_get_secret_serves_stale_on_refresh_failure(self, mock_settings):
+        """Test that the last known value is returned when a refresh fails."""
+        mock_settings.secret_cache_ttl_seconds = 0
+        error_response = {'Error': {'Code': 'ThrottlingException'}}
+        self.mock_client.get_secret_value.side_effect = [
+            {'SecretString': '{"password": "p1"}'},
+            ClientError(error_response, 'GetSecretValue')
+        ]
+        
+        assert self.secrets_mgr.get_secret("test-secret") == {"password": "p1"}
+        assert self.secrets_mgr.get_secret("test-secret") == {"password": "p1"}
 
-    @patch('app.secrets.boto3.client')
-    def test_get_secret_invalid_request(self, mock_boto_client):
-        """Test invalid request error."""
-        mock_client = Mock()
-        mock_boto_client.return_value = mock_client
-        
-        error_response = {'Error': {'Code': 'InvalidRequestException'}}
-        mock_client.get_secret_value.side_effect = ClientError(error_response, 'GetSecretValue')
-        
-        secrets_mgr = SecretsManager()
-        with pytest.raises(Exception) as exc_info:
-            secrets_mgr.get_secret("test-secret")
-        
-        assert "not valid for the current state" in str(exc_info.value)
+    @patch('app.secrets.time.monotonic')
+    @patch('app.secrets.settings')
+    def test_get_secret_backs_off_after_refresh_failure(self, mock_settings, mock_monotonic):
+        """Test that a failed refresh isn't retried on every call."""
+        mock_settings.secret_cache_ttl_seconds = 10
+        error_response = {'Error': {'Code': 'ThrottlingException'}}
+        self.mock_client.get_secret_value.side_effect = [
+            {'SecretString': '{"password": "p1"}'},
+            ClientError(error_response, 'GetSecretValue')
+        ]
+        
+        mock_monotonic.return_value = 0
+        self.secrets_mgr.get_secret("test-secret")
+        mock_monotonic.return_value = 20
+        assert self.secrets_mgr.get_secret("test-secret") == {"password": "p1"}
+        mock_monotonic.return_value = 30
+        assert self.secrets_mgr.get_secret("test-secret") == {"password": "p1"}
+        
+        assert self.mock_client.get_secret_value.call_count == 2
 
     @patch.object(SecretsManager, 'get_secret')
     def test_get_snowflake_credentials(self, mock_get_secret):
@@ -119,8 +132,7 @@ class TestSecretsManager:
         }
         mock_get_secret.return_value = mock_credentials
         
-        secrets_mgr = SecretsManager()
-        result = secrets_mgr.get_snowflake_credentials()
+        result = self.secrets_mgr.get_snowflake_credentials()
         
         assert result == mock_credentials
         mock_get_secret.assert_called_once_with("snowflake-credentials")